@@ -1,7 +1,21 @@
 # -*- coding: utf-8 -*-
 import sqlite3
-from threading import Semaphore
-from typing import Any, Dict, Optional, Tuple, Type, TypeVar, cast
+from itertools import islice
+from threading import Condition, Event, Lock, Semaphore
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Protocol,
+    Tuple,
+    Type,
+    TypeVar,
+    Union,
+    cast,
+)
+from uuid import uuid4
 
 import sqlalchemy.exc
 from eventsourcing.persistence import (
@@ -15,10 +29,12 @@ from eventsourcing.persistence import (
     PersistenceError,
     ProgrammingError,
 )
-from sqlalchemy import Index, text
+from sqlalchemy import Index, Table, event, insert, text
+from sqlalchemy.engine import URL, Connection, make_url
 from sqlalchemy.future import create_engine
 from sqlalchemy.orm import Session, sessionmaker
-from sqlalchemy.pool import StaticPool
+from sqlalchemy.pool import Pool, QueuePool, StaticPool
+from sqlalchemy.sql.dml import Insert
 
 from eventsourcing_sqlalchemy.models import (  # type: ignore
     EventRecord,
@@ -29,164 +45,410 @@ from eventsourcing_sqlalchemy.models import (  # type: ignore
 
 TEventRecord = TypeVar("TEventRecord", bound=EventRecord)
 
+SQLITE_PRAGMAS: Dict[str, Any] = {
+    "synchronous": "NORMAL",
+    "cache_size": -65536,
+    "temp_store": "MEMORY",
+    "mmap_size": 268435456,
+    "wal_autocheckpoint": 10000,
+}
+
+# Maps SQLAlchemy exceptions to persistence errors, looked up by the MRO of
+# the raised exception so that the most specific class wins.
+PERSISTENCE_ERRORS: Dict[Type[Exception], Type[PersistenceError]] = {
+    sqlalchemy.exc.IntegrityError: IntegrityError,
+    sqlalchemy.exc.OperationalError: OperationalError,
+    sqlalchemy.exc.InterfaceError: InterfaceError,
+    sqlalchemy.exc.DataError: DataError,
+    sqlalchemy.exc.InternalError: InternalError,
+    sqlalchemy.exc.ProgrammingError: ProgrammingError,
+    sqlalchemy.exc.NotSupportedError: NotSupportedError,
+    sqlalchemy.exc.DatabaseError: DatabaseError,
+    sqlalchemy.exc.SQLAlchemyError: PersistenceError,
+}
+
+
+def persistence_error(e: sqlalchemy.exc.SQLAlchemyError) -> Type[PersistenceError]:
+    for exc_cls in type(e).__mro__:
+        if exc_cls in PERSISTENCE_ERRORS:
+            return PERSISTENCE_ERRORS[exc_cls]
+    return PersistenceError
+
+
+class TransactionLock(Protocol):
+    def acquire(self) -> Any:
+        pass
+
+    def release(self) -> None:
+        pass
+
+
+class ReadWriteLock:
+    """
+    Lets any number of readers, or a single writer, hold the lock.
+    Waiting writers block new readers, so that writers are not starved.
+    """
+
+    def __init__(self) -> None:
+        self._condition = Condition()
+        self._num_readers = 0
+        self._num_writers_waiting = 0
+        self._is_writing = False
+        self.read_lock = _ReadLock(self)
+        self.write_lock = _WriteLock(self)
+
+    def acquire_read(self) -> None:
+        with self._condition:
+            while self._is_writing or self._num_writers_waiting:
+                self._condition.wait()
+            self._num_readers += 1
+
+    def release_read(self) -> None:
+        with self._condition:
+            self._num_readers -= 1
+            if not self._num_readers:
+                self._condition.notify_all()
+
+    def acquire_write(self) -> None:
+        with self._condition:
+            self._num_writers_waiting += 1
+            while self._is_writing or self._num_readers:
+                self._condition.wait()
+            self._num_writers_waiting -= 1
+            self._is_writing = True
+
+    def release_write(self) -> None:
+        with self._condition:
+            self._is_writing = False
+            self._condition.notify_all()
+
+
+class _ReadLock:
+    def __init__(self, rw_lock: ReadWriteLock):
+        self.acquire = rw_lock.acquire_read
+        self.release = rw_lock.release_read
+
+
+class _WriteLock:
+    def __init__(self, rw_lock: ReadWriteLock):
+        self.acquire = rw_lock.acquire_write
+        self.release = rw_lock.release_write
+
 
 class Transaction:
-    def __init__(self, session: Session, commit: bool, lock: Optional[Semaphore]):
-        self.session = session
+    def __init__(self, session: Session, commit: bool, lock: Optional[TransactionLock]):
+        self.session: Optional[Session] = session
         self.commit = commit
         self.lock = lock
 
     def __enter__(self) -> Session:
-        self.session.begin()
+        if self.session is None:
+            raise RuntimeError("Transaction has already been exited")
+        # The session begins a transaction when it is first used.
         return self.session
 
     def __exit__(self, exc_type: Any, exc_val: Any, exc_tb: Any) -> None:
+        # Drop the reference, so the session can be collected once closed.
+        session = cast(Session, self.session)
+        self.session = None
         try:
-            if exc_val:
-                self.session.rollback()
-                raise exc_val
+            if exc_val is not None:
+                session.rollback()
+            elif not session.in_transaction():
+                pass
             elif not self.commit:
                 try:
-                    self.session.rollback()
+                    session.rollback()
                 except sqlite3.OperationalError:
                     pass
             else:
-                self.session.commit()
-        except sqlalchemy.exc.InterfaceError as e:
-            raise InterfaceError from e
-        except sqlalchemy.exc.DataError as e:
-            raise DataError from e
-        except sqlalchemy.exc.OperationalError as e:
-            if isinstance(e.args[0], sqlite3.OperationalError) and self.lock:
+                session.commit()
+        except sqlalchemy.exc.SQLAlchemyError as e:
+            if (
+                isinstance(e, sqlalchemy.exc.OperationalError)
+                and isinstance(e.args[0], sqlite3.OperationalError)
+                and self.lock
+            ):
                 pass
             else:
-                raise OperationalError from e
-        except sqlalchemy.exc.IntegrityError as e:
-            raise IntegrityError from e
-        except sqlalchemy.exc.InternalError as e:
-            raise InternalError from e
-        except sqlalchemy.exc.ProgrammingError as e:
-            raise ProgrammingError from e
-        except sqlalchemy.exc.NotSupportedError as e:
-            raise NotSupportedError from e
-        except sqlalchemy.exc.DatabaseError as e:
-            raise DatabaseError from e
-        except sqlalchemy.exc.SQLAlchemyError as e:
-            raise PersistenceError from e
+                raise persistence_error(e) from e
         finally:
-            self.session.close()
+            session.close()
             if self.lock is not None:
                 # print(get_ident(), "releasing lock")
                 self.lock.release()
+        # Other exceptions propagate unchanged when this method returns.
+        if isinstance(exc_val, sqlalchemy.exc.SQLAlchemyError):
+            raise persistence_error(exc_val) from exc_val
 
 
 class SQLAlchemyDatastore:
     record_classes: Dict[str, Tuple[Type[EventRecord], Type[EventRecord]]] = {}
+    record_classes_lock = Lock()
 
     def __init__(self, **kwargs: Any):
-        kwargs = dict(kwargs)
-        self.access_lock: Optional[Semaphore] = kwargs.get("access_lock") or None
-        self.write_lock: Optional[Semaphore] = kwargs.get("access_lock") or None
-        self.is_sqlite_in_memory_db = kwargs.get("is_sqlite_in_memory_db") or False
-        self._init_session(kwargs)
-        self._init_sqlite_wal_mode()
-        self._init_record_cls(kwargs)
+        # Separate the datastore's own options, so that only engine
+        # options are passed on to create_engine().
+        engine_kwargs = dict(kwargs)
+        access_lock = engine_kwargs.pop("access_lock", None)
+        is_sqlite_in_memory_db = engine_kwargs.pop("is_sqlite_in_memory_db", False)
+        sqlite_pragmas = engine_kwargs.pop("sqlite_pragmas", {})
+        url: Optional[str] = engine_kwargs.pop("url", None)
+        session_cls: Optional[sessionmaker] = engine_kwargs.pop("session_cls", None)
+        connect_args: Dict[str, Any] = dict(
+            engine_kwargs.pop("connect_args", None) or {}
+        )
+        poolclass: Optional[Type[Pool]] = engine_kwargs.pop("poolclass", None)
+        snapshot_record_cls = engine_kwargs.pop("snapshot_record_cls", None)
+        stored_event_record_cls = engine_kwargs.pop("stored_event_record_cls", None)
+        notification_tracking_record_cls = engine_kwargs.pop(
+            "notification_tracking_record_cls", None
+        )
 
-    def _init_session(self, kwargs: Dict[Any, Any]) -> None:
-        url: Optional[str] = kwargs.get("url") or None
-        session_cls = kwargs.get("session_cls") or None
+        self.access_lock: Optional[Union[Semaphore, ReadWriteLock]] = (
+            access_lock or None
+        )
+        self.write_lock: Optional[Semaphore] = access_lock or None
+        self.is_sqlite_in_memory_db = is_sqlite_in_memory_db or False
+        self.sqlite_pragmas = dict(SQLITE_PRAGMAS, **sqlite_pragmas)
+        self._insert_stmts: Dict[Table, Insert] = {}
+        self._sqlite_in_memory_db_connection: Optional[Any] = None
         if url:
-            return self._init_session_with_url(url, kwargs)
+            self._init_session_with_url(url, connect_args, poolclass, engine_kwargs)
         elif session_cls:
-            return self._init_session_with_session_cls(session_cls)
+            self._init_session_with_session_cls(session_cls)
         else:
             raise EnvironmentError(
                 "SQLAlchemy Datastore must be created with url or session_cls param"
             )
+        self._init_sqlite_wal_mode()
+        self._init_record_cls(
+            snapshot_record_cls,
+            stored_event_record_cls,
+            notification_tracking_record_cls,
+        )
 
-    def _init_session_with_url(self, url: str, kwargs: Dict[Any, Any]) -> None:
-        if url.startswith("sqlite"):
-            if ":memory:" in url or "mode=memory" in url:
+    def _init_session_with_url(
+        self,
+        url: Union[str, URL],
+        connect_args: Dict[str, Any],
+        poolclass: Optional[Type[Pool]],
+        engine_kwargs: Dict[str, Any],
+    ) -> None:
+        if str(url).startswith("sqlite"):
+            if ":memory:" in str(url) or "mode=memory" in str(url):
                 self.is_sqlite_in_memory_db = True
-                connect_args = kwargs.get("connect_args") or {}
-                if "check_same_thread" not in connect_args:
-                    connect_args["check_same_thread"] = False
-                kwargs["connect_args"] = connect_args
-                if "poolclass" not in kwargs:
-                    kwargs["poolclass"] = StaticPool
-                self.access_lock = Semaphore()
+                sqlite_url = make_url(url)
+                if sqlite_url.database == ":memory:":
+                    # Use a uniquely named database with a shared cache, so
+                    # that pooled connections share the same database.
+                    url = sqlite_url.set(
+                        database=f"file:{uuid4().hex}",
+                        query=dict(
+                            sqlite_url.query,
+                            mode="memory",
+                            cache="shared",
+                            uri="true",
+                        ),
+                    )
+                connect_args.setdefault("check_same_thread", False)
+                if sqlite_url.database == ":memory:" or (
+                    sqlite_url.query.get("cache") == "shared"
+                ):
+                    self.access_lock = ReadWriteLock()
+                else:
+                    # Without a shared cache, each connection would have its
+                    # own database, so use a single connection exclusively.
+                    if poolclass is None:
+                        poolclass = StaticPool
+                    self.access_lock = Semaphore()
             else:
+                connect_args.setdefault("timeout", 30)
+                connect_args.setdefault("check_same_thread", False)
                 self.write_lock = Semaphore()
+            if poolclass is None:
+                poolclass = QueuePool
+                engine_kwargs.setdefault("pool_size", 5)
+                engine_kwargs.setdefault("max_overflow", 10)
 
-        self.engine = create_engine(echo=False, **kwargs)
+        engine_kwargs.setdefault("query_cache_size", 1200)
+        if connect_args:
+            engine_kwargs["connect_args"] = connect_args
+        if poolclass is not None:
+            engine_kwargs["poolclass"] = poolclass
+        self.engine = create_engine(url, echo=False, **engine_kwargs)
+        self._owns_engine = True
         self.session_cls: sessionmaker = sessionmaker(bind=self.engine)
+        if self.is_sqlite_in_memory_db:
+            # The database is discarded when its last connection is closed.
+            self._sqlite_in_memory_db_connection = self.engine.raw_connection()
 
     def _init_session_with_session_cls(self, session_cls: sessionmaker) -> None:
         self.session_cls = session_cls
         self.engine = session_cls().get_bind()
+        self._owns_engine = False
 
     def _init_sqlite_wal_mode(self) -> None:
-        self.is_sqlite_wal_mode = False
-        if self.engine.dialect.name != "sqlite":
-            return
-        if self.is_sqlite_in_memory_db:
+        self._is_sqlite_wal_mode = False
+        self._is_sqlite_wal_mode_known = Event()
+        if self.engine.dialect.name != "sqlite" or self.is_sqlite_in_memory_db:
+            self._is_sqlite_wal_mode_known.set()
             return
-        with self.engine.connect() as connection:
-            cursor_result = connection.execute(text("PRAGMA journal_mode=WAL;"))
-            if list(cursor_result)[0][0] == "wal":
-                self.is_sqlite_wal_mode = True
-
-    def _init_record_cls(self, kwargs: Dict[Any, Any]) -> None:
-        self.snapshot_record_cls = kwargs.get("snapshot_record_cls") or SnapshotRecord
-        self.stored_event_record_cls = (
-            kwargs.get("stored_event_record_cls") or StoredEventRecord
-        )
+        # Pragmas are per-connection, so apply them to every new connection.
+        event.listen(self.engine, "connect", self._on_sqlite_connect)
+        event.listen(self.engine, "begin", self._on_sqlite_begin)
+
+    @property
+    def is_sqlite_wal_mode(self) -> bool:
+        if not self._is_sqlite_wal_mode_known.is_set():
+            # Nothing has connected yet, so connect to run _on_sqlite_connect().
+            with self.engine.connect():
+                pass
+        return self._is_sqlite_wal_mode
+
+    def _on_sqlite_connect(self, dbapi_connection: Any, _: Any) -> None:
+        # Stop pysqlite issuing its own BEGIN, see _on_sqlite_begin().
+        dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        try:
+            cursor.execute("PRAGMA journal_mode=WAL;")
+            if cursor.fetchone()[0] == "wal":
+                for name, value in self.sqlite_pragmas.items():
+                    if value is not None:
+                        cursor.execute(f"PRAGMA {name}={value};")
+                self._is_sqlite_wal_mode = True
+        finally:
+            cursor.close()
+        self._is_sqlite_wal_mode_known.set()
+
+    @staticmethod
+    def _on_sqlite_begin(connection: Connection) -> None:
+        connection.exec_driver_sql("BEGIN")
+
+    def _init_record_cls(
+        self,
+        snapshot_record_cls: Optional[Type[SnapshotRecord]],
+        stored_event_record_cls: Optional[Type[StoredEventRecord]],
+        notification_tracking_record_cls: Optional[Type[NotificationTrackingRecord]],
+    ) -> None:
+        self.snapshot_record_cls = snapshot_record_cls or SnapshotRecord
+        self.stored_event_record_cls = stored_event_record_cls or StoredEventRecord
         self.notification_tracking_record_cls = (
-            kwargs.get("notification_tracking_record_cls") or NotificationTrackingRecord
+            notification_tracking_record_cls or NotificationTrackingRecord
         )
 
     def transaction(self, commit: bool) -> Transaction:
-        lock: Optional[Semaphore] = None
-        if self.access_lock:
-            self.access_lock.acquire()
+        # Create the session before taking the lock, to keep the lock short.
+        if commit:
+            session = self.session_cls()
+        else:
+            session = self.session_cls(autoflush=False)
+        lock: Optional[TransactionLock] = None
+        if isinstance(self.access_lock, ReadWriteLock):
+            if commit:
+                lock = self.access_lock.write_lock
+            else:
+                lock = self.access_lock.read_lock
+        elif self.access_lock:
             lock = self.access_lock
         elif commit and self.write_lock:
-            # print(get_ident(), "getting lock")
-            self.write_lock.acquire()
-            # print(get_ident(), "got lock")
             lock = self.write_lock
-        return Transaction(self.session_cls(), commit=commit, lock=lock)
+        if lock is not None:
+            try:
+                lock.acquire()
+            except BaseException:
+                session.close()
+                raise
+        return Transaction(session, commit=commit, lock=lock)
+
+    def optimize(self) -> None:
+        if self.engine.dialect.name == "sqlite":
+            with self.transaction(commit=True) as session:
+                session.execute(text("PRAGMA optimize;"))
+
+    def close(self) -> None:
+        if self.engine.dialect.name == "sqlite" and self._is_sqlite_wal_mode:
+            # Write the WAL back into the database, and truncate the WAL file.
+            connection = self.engine.raw_connection()
+            try:
+                cursor = connection.cursor()
+                try:
+                    cursor.execute("PRAGMA wal_checkpoint(TRUNCATE);")
+                finally:
+                    cursor.close()
+            finally:
+                connection.close()
+        if self._sqlite_in_memory_db_connection is not None:
+            self._sqlite_in_memory_db_connection.close()
+            self._sqlite_in_memory_db_connection = None
+        # An engine given with session_cls belongs to the caller.
+        if self._owns_engine:
+            self.engine.dispose()
+
+    def bulk_transaction(
+        self, table: Table, rows: Iterable[Dict[str, Any]], batch_size: int = 500
+    ) -> None:
+        rows = iter(rows)
+        with self.transaction(commit=True) as session:
+            while True:
+                batch = list(islice(rows, batch_size))
+                if not batch:
+                    break
+                self.insert_many(session, table, batch)
+
+    def insert_stmt(self, table: Table) -> Insert:
+        try:
+            return self._insert_stmts[table]
+        except KeyError:
+            return self._insert_stmts.setdefault(table, insert(table))
+
+    def insert_many(
+        self, session: Session, table: Table, rows: List[Dict[str, Any]]
+    ) -> None:
+        session.execute(self.insert_stmt(table), rows)
 
     @classmethod
     def define_record_class(
         cls, name: str, table_name: str, base_cls: Type[TEventRecord]
     ) -> Type[TEventRecord]:
-        try:
-            (record_class, record_base_cls) = cls.record_classes[table_name]
-            if record_base_cls is not base_cls:
-                raise ValueError(
-                    f"Have already defined a record class with table name {table_name} "
-                    f"from a different base class {record_base_cls}"
-                )
-        except KeyError:
-            table_args = []
-            for table_arg in base_cls.__dict__.get("__table_args__", []):
-                if isinstance(table_arg, Index):
-                    new_index = Index(
-                        f"{table_name}_aggregate_idx",
-                        unique=table_arg.unique,
-                        *table_arg.expressions,  # noqa B026
+        entry = cls.record_classes.get(table_name)
+        if entry is None:
+            with cls.record_classes_lock:
+                entry = cls.record_classes.get(table_name)
+                if entry is None:
+                    entry = (
+                        cls._create_record_class(name, table_name, base_cls),
+                        base_cls,
                     )
-                    table_args.append(new_index)
-                else:
-                    table_args.append(table_arg)
-            record_class = type(
-                name,
-                (base_cls,),
-                {
-                    "__tablename__": table_name,
-                    "__table_args__": tuple(table_args),
-                },
+                    cls.record_classes[table_name] = entry
+        record_class, record_base_cls = entry
+        if record_base_cls is not base_cls:
+            raise ValueError(
+                f"Have already defined a record class with table name {table_name} "
+                f"from a different base class {record_base_cls}"
             )
-            cls.record_classes[table_name] = (record_class, base_cls)
         return cast(Type[TEventRecord], record_class)
+
+    @staticmethod
+    def _create_record_class(
+        name: str, table_name: str, base_cls: Type[EventRecord]
+    ) -> Type[EventRecord]:
+        table_args = []
+        for table_arg in base_cls.__dict__.get("__table_args__", []):
+            if isinstance(table_arg, Index):
+                new_index = Index(
+                    f"{table_name}_aggregate_idx",
+                    unique=table_arg.unique,
+                    *table_arg.expressions,  # noqa B026
+                )
+                table_args.append(new_index)
+            else:
+                table_args.append(table_arg)
+        return type(
+            name,
+            (base_cls,),
+            {
+                "__tablename__": table_name,
+                "__table_args__": tuple(table_args),
+            },
+        )
@@ -1,8 +1,11 @@
 # -*- coding: utf-8 -*-
+from threading import Event, Thread
+
 from eventsourcing.persistence import (
     AggregateRecorder,
     ApplicationRecorder,
     InfrastructureFactory,
+    PersistenceError,
     ProcessRecorder,
 )
 from eventsourcing.utils import Environment, resolve_topic, strtobool
@@ -18,6 +21,7 @@ from eventsourcing_sqlalchemy.recorders import (
 class Factory(InfrastructureFactory):
     SQLALCHEMY_URL = "SQLALCHEMY_URL"
     SQLALCHEMY_CONNECTION_CREATOR_TOPIC = "SQLALCHEMY_CONNECTION_CREATOR_TOPIC"
+    SQLALCHEMY_SQLITE_OPTIMIZE_INTERVAL = "SQLALCHEMY_SQLITE_OPTIMIZE_INTERVAL"
     CREATE_TABLE = "CREATE_TABLE"
 
     def __init__(self, env: Environment):
@@ -34,6 +38,22 @@ class Factory(InfrastructureFactory):
         if isinstance(creator_topic, str):
             kwargs["creator"] = resolve_topic(creator_topic)
         self.datastore = SQLAlchemyDatastore(url=db_url, **kwargs)
+        self.optimize_stopped = Event()
+        optimize_interval = self.env.get(self.SQLALCHEMY_SQLITE_OPTIMIZE_INTERVAL)
+        if optimize_interval:
+            optimize_thread = Thread(
+                target=self.optimize_periodically,
+                args=(float(optimize_interval),),
+                daemon=True,
+            )
+            optimize_thread.start()
+
+    def optimize_periodically(self, interval: float) -> None:
+        while not self.optimize_stopped.wait(timeout=interval):
+            try:
+                self.datastore.optimize()
+            except PersistenceError:
+                pass
 
     def aggregate_recorder(self, purpose: str = "events") -> AggregateRecorder:
         prefix = self.env.name.lower() or "stored"
@@ -75,3 +95,8 @@ class Factory(InfrastructureFactory):
     def env_create_table(self) -> bool:
         default = "yes"
         return bool(strtobool(self.env.get(self.CREATE_TABLE) or default))
+
+    def close(self) -> None:
+        self.optimize_stopped.set()
+        self.datastore.close()
+        super().close()
@@ -1,5 +1,5 @@
 # -*- coding: utf-8 -*-
-from typing import Any, List, Optional, Sequence, Type, cast
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Type
 from uuid import UUID
 
 from eventsourcing.persistence import (
@@ -10,8 +10,9 @@ from eventsourcing.persistence import (
     StoredEvent,
     Tracking,
 )
-from sqlalchemy import Column, Table
+from sqlalchemy import Table, bindparam, func, insert, select
 from sqlalchemy.orm import Session
+from sqlalchemy.sql import Select
 
 from eventsourcing_sqlalchemy.datastore import SQLAlchemyDatastore
 from eventsourcing_sqlalchemy.models import (  # type: ignore
@@ -41,6 +42,7 @@ class SQLAlchemyAggregateRecorder(AggregateRecorder):
             name=record_cls_name, table_name=self.events_table_name, base_cls=base_cls
         )
         self.stored_events_table = self.events_record_cls.__table__
+        self._select_events_stmts: Dict[Tuple[bool, bool, bool, bool], Select] = {}
 
     def create_table(self) -> None:
         self.stored_events_table.create(self.datastore.engine, checkfirst=True)
@@ -57,23 +59,38 @@ class SQLAlchemyAggregateRecorder(AggregateRecorder):
     ) -> Optional[Sequence[int]]:
         if len(stored_events) == 0:
             return []
-        records = [
-            self.events_record_cls(
-                originator_id=e.originator_id,
-                originator_version=e.originator_version,
-                topic=e.topic,
-                state=e.state,
-            )
-            for e in stored_events
-        ]
+        rows = self._stored_events_rows(stored_events)
         self._lock_table(session)
-        for record in records:
-            session.add(record)
-        session.flush()
-        if issubclass(self.events_record_cls, StoredEventRecord):
-            return [cast(StoredEventRecord, r).id for r in records]
-        else:
+        if not issubclass(self.events_record_cls, StoredEventRecord):
+            self.datastore.insert_many(session, self.stored_events_table, rows)
             return None
+        table = self.stored_events_table
+        dialect_name = self.datastore.engine.dialect.name
+        if dialect_name == "postgresql":
+            stmt = insert(table).values(rows).returning(table.c.id)
+            return list(session.execute(stmt).scalars())
+        if dialect_name == "sqlite":
+            # SQLite's database write lock serializes inserts until the
+            # transaction ends, so the new IDs are the range ending at the max ID.
+            self.datastore.insert_many(session, table, rows)
+            max_id = session.execute(select(func.max(table.c.id))).scalar()
+            return list(range(max_id - len(rows) + 1, max_id + 1))
+        insert_stmt = self.datastore.insert_stmt(table)
+        return [
+            session.execute(insert_stmt, row).inserted_primary_key[0] for row in rows
+        ]
+
+    @staticmethod
+    def _stored_events_rows(stored_events: List[StoredEvent]) -> List[Dict[str, Any]]:
+        return [
+            {
+                "originator_id": e.originator_id,
+                "originator_version": e.originator_version,
+                "topic": e.topic,
+                "state": e.state,
+            }
+            for e in stored_events
+        ]
 
     def _lock_table(self, session: Session) -> None:
         if self.datastore.engine.dialect.name == "postgresql":
@@ -87,22 +104,21 @@ class SQLAlchemyAggregateRecorder(AggregateRecorder):
         desc: bool = False,
         limit: Optional[int] = None,
     ) -> List[StoredEvent]:
+        stmt = self._select_events_stmt(
+            has_gt=gt is not None,
+            has_lte=lte is not None,
+            desc=desc,
+            has_limit=limit is not None,
+        )
+        params: Dict[str, Any] = {"originator_id": originator_id}
+        if gt is not None:
+            params["gt"] = gt
+        if lte is not None:
+            params["lte"] = lte
+        if limit is not None:
+            params["limit"] = limit
         with self.datastore.transaction(commit=False) as session:
-            q = session.query(self.events_record_cls)
-            q = q.filter(self.events_record_cls.originator_id == originator_id)
-            originator_version: Column[int] = self.events_record_cls.originator_version
-            if gt is not None:
-                q = q.filter(originator_version > gt)
-            if lte is not None:
-                q = q.filter(originator_version <= lte)
-            if desc:
-                q = q.order_by(originator_version.desc())
-            else:
-                q = q.order_by(originator_version)
-            if limit is not None:
-                records = q[0:limit]
-            else:
-                records = list(q)
+            records = session.execute(stmt, params)
 
             stored_events = [
                 StoredEvent(
@@ -117,6 +133,34 @@ class SQLAlchemyAggregateRecorder(AggregateRecorder):
             ]
         return stored_events
 
+    def _select_events_stmt(
+        self, has_gt: bool, has_lte: bool, desc: bool, has_limit: bool
+    ) -> Select:
+        # Build each variant of the statement once, with bound parameters.
+        key = (has_gt, has_lte, desc, has_limit)
+        try:
+            return self._select_events_stmts[key]
+        except KeyError:
+            pass
+        table = self.stored_events_table
+        stmt = select(
+            table.c.originator_id,
+            table.c.originator_version,
+            table.c.topic,
+            table.c.state,
+        ).where(table.c.originator_id == bindparam("originator_id"))
+        if has_gt:
+            stmt = stmt.where(table.c.originator_version > bindparam("gt"))
+        if has_lte:
+            stmt = stmt.where(table.c.originator_version <= bindparam("lte"))
+        if desc:
+            stmt = stmt.order_by(table.c.originator_version.desc())
+        else:
+            stmt = stmt.order_by(table.c.originator_version)
+        if has_limit:
+            stmt = stmt.limit(bindparam("limit"))
+        return self._select_events_stmts.setdefault(key, stmt)
+
 
 class SQLAlchemyApplicationRecorder(SQLAlchemyAggregateRecorder, ApplicationRecorder):
     def insert_events(
@@ -128,16 +172,10 @@ class SQLAlchemyApplicationRecorder(SQLAlchemyAggregateRecorder, ApplicationReco
 
     def max_notification_id(self) -> int:
         with self.datastore.transaction(commit=False) as session:
-            # record_class = cast(Type[StoredEventRecord], self.events_record_cls)
-            record_class = self.events_record_cls
-            q = session.query(record_class)
-            q = q.order_by(record_class.id.desc())
-            records = q[0:1]
-            try:
-                max_id = records[0].id
-            except IndexError:
-                max_id = 0
-        return max_id
+            max_id = session.execute(
+                select(func.max(self.stored_events_table.c.id))
+            ).scalar()
+        return max_id or 0
 
     def select_notifications(
         self,
@@ -200,23 +238,26 @@ class SQLAlchemyProcessRecorder(SQLAlchemyApplicationRecorder, ProcessRecorder):
         )
         tracking: Optional[Tracking] = kwargs.get("tracking", None)
         if tracking is not None:
-            record = self.tracking_record_cls(
-                application_name=tracking.application_name,
-                notification_id=tracking.notification_id,
+            self.datastore.insert_many(
+                session,
+                self.tracking_table,
+                [
+                    {
+                        "application_name": tracking.application_name,
+                        "notification_id": tracking.notification_id,
+                    }
+                ],
             )
-            session.add(record)
         return notification_ids
 
     def max_tracking_id(self, application_name: str) -> int:
         with self.datastore.transaction(commit=False) as session:
-            q = session.query(self.tracking_record_cls)
-            q = q.filter(self.tracking_record_cls.application_name == application_name)
-            q = q.order_by(self.tracking_record_cls.notification_id.desc())
-            try:
-                max_id = q[0].notification_id
-            except IndexError:
-                max_id = 0
-        return max_id
+            max_id = session.execute(
+                select(func.max(self.tracking_table.c.notification_id)).where(
+                    self.tracking_table.c.application_name == application_name
+                )
+            ).scalar()
+        return max_id or 0
 
     def has_tracking_id(self, application_name: str, notification_id: int) -> bool:
         with self.datastore.transaction(commit=False) as session:
@@ -1,10 +1,17 @@
 # -*- coding: utf-8 -*-
+import os
+from threading import Event, Semaphore, Thread
 from unittest import TestCase
+from uuid import uuid4
 
+from eventsourcing.persistence import OperationalError
+from eventsourcing.tests.persistence import tmpfile_uris
+from sqlalchemy import text
 from sqlalchemy.future import create_engine
 from sqlalchemy.orm import sessionmaker
 
-from eventsourcing_sqlalchemy.datastore import SQLAlchemyDatastore
+from eventsourcing_sqlalchemy.datastore import ReadWriteLock, SQLAlchemyDatastore
+from eventsourcing_sqlalchemy.models import SnapshotRecord  # type: ignore
 
 
 class TestDatastore(TestCase):
@@ -20,3 +27,140 @@ class TestDatastore(TestCase):
     def test_should_raise_exception_without_url_or_session_cls(self) -> None:
         with self.assertRaises(EnvironmentError):
             SQLAlchemyDatastore()
+
+    def test_sqlite_pragmas_can_be_overridden(self) -> None:
+        uris = tmpfile_uris()
+        db_url = f"sqlite:///{next(uris).lstrip('file:')}"
+        datastore = SQLAlchemyDatastore(
+            url=db_url, sqlite_pragmas={"busy_timeout": 15000, "mmap_size": None}
+        )
+        self.assertTrue(datastore.is_sqlite_wal_mode)
+        with datastore.transaction(commit=False) as session:
+            busy_timeout = session.execute(text("PRAGMA busy_timeout;")).scalar()
+            self.assertEqual(busy_timeout, 15000)
+            # A value of None skips the pragma, leaving SQLite's default.
+            mmap_size = session.execute(text("PRAGMA mmap_size;")).scalar()
+            self.assertEqual(mmap_size, 0)
+            cache_size = session.execute(text("PRAGMA cache_size;")).scalar()
+            self.assertEqual(cache_size, -65536)
+
+    def test_sqlite_pragmas_are_applied_to_each_connection(self) -> None:
+        uris = tmpfile_uris()
+        db_url = f"sqlite:///{next(uris).lstrip('file:')}"
+        datastore = SQLAlchemyDatastore(url=db_url)
+        for _ in range(2):
+            with datastore.transaction(commit=False) as session:
+                journal_mode = session.execute(text("PRAGMA journal_mode;"))
+                self.assertEqual(list(journal_mode)[0][0], "wal")
+                synchronous = session.execute(text("PRAGMA synchronous;"))
+                self.assertEqual(list(synchronous)[0][0], 1)
+
+    def test_bulk_transaction(self) -> None:
+        datastore = SQLAlchemyDatastore(url="sqlite:///:memory:")
+        record_cls = datastore.define_record_class(
+            name="BulkStoredEvent",
+            table_name="bulk_stored_events",
+            base_cls=datastore.stored_event_record_cls,
+        )
+        record_cls.__table__.create(datastore.engine)
+        originator_id = uuid4()
+        datastore.bulk_transaction(
+            record_cls.__table__,
+            (
+                {
+                    "originator_id": originator_id,
+                    "originator_version": i,
+                    "topic": "topic",
+                    "state": b"state",
+                }
+                for i in range(5)
+            ),
+            batch_size=2,
+        )
+        with datastore.transaction(commit=False) as session:
+            records = session.query(record_cls).order_by(record_cls.id).all()
+            self.assertEqual([r.originator_version for r in records], list(range(5)))
+            self.assertEqual([r.id for r in records], [1, 2, 3, 4, 5])
+
+    def test_sqlite_in_memory_db_allows_concurrent_readers(self) -> None:
+        datastore = SQLAlchemyDatastore(url="sqlite:///:memory:")
+        self.assertIsInstance(datastore.access_lock, ReadWriteLock)
+        writing = Event()
+
+        def write() -> None:
+            with datastore.transaction(commit=True):
+                writing.set()
+
+        with datastore.transaction(commit=False):
+            with datastore.transaction(commit=False):
+                writer = Thread(target=write)
+                writer.start()
+                self.assertFalse(writing.wait(timeout=0.1))
+        writer.join()
+        self.assertTrue(writing.is_set())
+
+    def test_datastore_options_are_not_passed_to_create_engine(self) -> None:
+        datastore = SQLAlchemyDatastore(
+            url="sqlite:///:memory:",
+            access_lock=None,
+            is_sqlite_in_memory_db=True,
+            snapshot_record_cls=SnapshotRecord,
+        )
+        self.assertIs(datastore.snapshot_record_cls, SnapshotRecord)
+
+    def test_transaction_releases_session_on_exit(self) -> None:
+        datastore = SQLAlchemyDatastore(url="sqlite:///:memory:")
+        transaction = datastore.transaction(commit=False)
+        with transaction:
+            self.assertIsNotNone(transaction.session)
+        self.assertIsNone(transaction.session)
+        with self.assertRaises(RuntimeError):
+            transaction.__enter__()
+
+    def test_close_checkpoints_and_truncates_wal_file(self) -> None:
+        uris = tmpfile_uris()
+        db_path = next(uris).lstrip("file:")
+        datastore = SQLAlchemyDatastore(url=f"sqlite:///{db_path}")
+        self.assertTrue(datastore.is_sqlite_wal_mode)
+        with datastore.transaction(commit=True) as session:
+            session.execute(text("CREATE TABLE t (i INTEGER);"))
+            session.execute(text("INSERT INTO t VALUES (1);"))
+        self.assertGreater(os.path.getsize(db_path + "-wal"), 0)
+        datastore.close()
+        self.assertFalse(
+            os.path.exists(db_path + "-wal") and os.path.getsize(db_path + "-wal")
+        )
+
+    def test_transaction_propagates_other_exceptions_unchanged(self) -> None:
+        datastore = SQLAlchemyDatastore(url="sqlite:///:memory:")
+        with self.assertRaises(KeyError):
+            with datastore.transaction(commit=True):
+                raise KeyError("not a database error")
+        with self.assertRaises(OperationalError):
+            with datastore.transaction(commit=True) as session:
+                session.execute(text("SELECT * FROM not_a_table;"))
+
+    def test_sqlite_in_memory_url_keeps_query_parameters(self) -> None:
+        datastore = SQLAlchemyDatastore(url="sqlite:///:memory:?timeout=7")
+        self.assertEqual(datastore.engine.url.query["timeout"], "7")
+        self.assertEqual(datastore.engine.url.query["cache"], "shared")
+
+    def test_sqlite_mode_memory_url_without_shared_cache_is_private(self) -> None:
+        url = f"sqlite:///file:{uuid4().hex}?mode=memory&uri=true"
+        datastore1 = SQLAlchemyDatastore(url=url)
+        datastore2 = SQLAlchemyDatastore(url=url)
+        self.assertIsInstance(datastore1.access_lock, Semaphore)
+        with datastore1.transaction(commit=True) as session:
+            session.execute(text("CREATE TABLE t (i INTEGER);"))
+        with self.assertRaises(OperationalError):
+            with datastore2.transaction(commit=False) as session:
+                session.execute(text("SELECT * FROM t;"))
+
+    def test_close_does_not_dispose_engine_of_session_cls(self) -> None:
+        engine = create_engine(url="sqlite:///:memory:")
+        with engine.begin() as connection:
+            connection.execute(text("CREATE TABLE t (i INTEGER);"))
+        datastore = SQLAlchemyDatastore(session_cls=sessionmaker(bind=engine))
+        datastore.close()
+        with engine.connect() as connection:
+            connection.execute(text("SELECT * FROM t;"))
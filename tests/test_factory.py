@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 import os
-from typing import Type
+from threading import Event
+from typing import Type, cast
+from unittest.mock import patch
 
 from eventsourcing.persistence import (
     AggregateRecorder,
@@ -41,6 +43,19 @@ class TestFactory(InfrastructureFactoryTestCase):
         self.env[Factory.SQLALCHEMY_URL] = "sqlite:///:memory:"
         super().setUp()
 
+    def test_optimize_interval(self) -> None:
+        self.factory.close()
+        env = self.env
+        assert env is not None
+        env[Factory.SQLALCHEMY_SQLITE_OPTIMIZE_INTERVAL] = "0.01"
+        factory = cast(Factory, InfrastructureFactory.construct(env))
+        optimized = Event()
+        with patch.object(factory.datastore, "optimize", side_effect=optimized.set):
+            self.assertTrue(optimized.wait(timeout=1))
+        self.assertFalse(factory.optimize_stopped.is_set())
+        factory.close()
+        self.assertTrue(factory.optimize_stopped.is_set())
+
     def tearDown(self) -> None:
         if Factory.SQLALCHEMY_URL in os.environ:
             del os.environ[Factory.SQLALCHEMY_URL]
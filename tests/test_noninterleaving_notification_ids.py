@@ -30,8 +30,9 @@ class TestNonInterleavingSQLiteFileDB(TestNonInterleaving):
     insert_num = 1000
 
     def setUp(self) -> None:
-        uris = tmpfile_uris()
-        db_uri = next(uris)
+        # Keep a reference, the temporary file is deleted when it is collected.
+        self.uris = tmpfile_uris()
+        db_uri = next(self.uris)
         db_uri = db_uri.lstrip("file:")
         self.sqlalchemy_db_url = f"sqlite:///{db_uri}"
         super().setUp()
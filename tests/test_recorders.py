@@ -18,7 +18,7 @@ from eventsourcing.tests.persistence import (
 from sqlalchemy.future import create_engine
 from sqlalchemy.orm import sessionmaker
 
-from eventsourcing_sqlalchemy.datastore import SQLAlchemyDatastore
+from eventsourcing_sqlalchemy.datastore import ReadWriteLock, SQLAlchemyDatastore
 from eventsourcing_sqlalchemy.recorders import (
     SQLAlchemyAggregateRecorder,
     SQLAlchemyApplicationRecorder,
@@ -89,7 +89,7 @@ class TestSQLAlchemyApplicationRecorder(ApplicationRecorderTestCase):
         self.assertFalse(self.datastore.is_sqlite_wal_mode)
         self.assertTrue(self.datastore.access_lock)
         self.assertFalse(self.datastore.write_lock)
-        self.assertIsInstance(self.datastore.access_lock, Semaphore)
+        self.assertIsInstance(self.datastore.access_lock, ReadWriteLock)
         super().test_concurrent_no_conflicts()
 
     def test_concurrent_no_conflicts_sqlite_filedb(self) -> None: